@@ -1,22 +1,26 @@
-from fastapi import FastAPI, Request, HTTPException, Depends, Form, File, UploadFile
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, Form, File, UploadFile
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 import uvicorn
 import os
 import json
+import orjson
 import asyncio
 from datetime import datetime, timedelta
 import hashlib
 import secrets
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Annotated
+from pydantic import AfterValidator, BaseModel
 import logging
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 import jwt
+from prometheus_fastapi_instrumentator import Instrumentator
 from telegram import Bot, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import aiohttp
@@ -45,14 +49,67 @@ miniapp_handler = None
 admin_handler = None
 file_manager = None
 
+def _orjson_default(obj: Any) -> Any:
+    """Serialize types orjson does not handle natively"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+class MongoJSONResponse(JSONResponse):
+    """orjson response that also understands Mongo documents
+    
+    Naive datetimes are UTC throughout the app and are emitted with an
+    explicit +00:00 offset.
+    """
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_orjson_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+        )
+
+def mongo_json(result: Any) -> Response:
+    """Wrap a handler result in MongoJSONResponse
+    
+    FastAPI runs jsonable_encoder over anything that is not already a
+    Response, so routes return this to have orjson serialize the raw
+    result. Responses built by the handlers pass through untouched.
+    """
+    if isinstance(result, Response):
+        return result
+    return MongoJSONResponse(result)
+
+class MediaAwareGZipMiddleware(GZipMiddleware):
+    """GZip middleware that leaves already-compressed media streams alone"""
+    def __init__(self, app, excluded_prefixes: tuple = (), **kwargs):
+        super().__init__(app, **kwargs)
+        self.excluded_prefixes = excluded_prefixes
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.excluded_prefixes):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+def _validate_object_id(value: str) -> str:
+    if not ObjectId.is_valid(value):
+        raise ValueError("must be a 24-character hex ObjectId")
+    return value
+
+# Path parameter holding a document _id; malformed values get a 422 from FastAPI
+ObjectIdStr = Annotated[str, AfterValidator(_validate_object_id)]
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     global db, telegram_bot, storage_manager, auth_manager, miniapp_handler, admin_handler, file_manager
     
-    # Initialize database
+    # Initialize database (connected below, together with the bot)
     db = Database()
-    await db.connect()
     
     # Initialize managers
     storage_manager = StorageManager(db)
@@ -65,10 +122,22 @@ async def lifespan(app: FastAPI):
     
     # Initialize Telegram bot
     telegram_bot = TelegramBot(db, storage_manager, file_manager)
-    await telegram_bot.initialize()
+    
+    # Mongo setup and bot/webhook registration are independent network round
+    # trips. The TaskGroup cancels the other one if either fails; anything the
+    # bot already set up (media workers, webhook) is then undone before exiting.
+    try:
+        async with asyncio.TaskGroup() as startup:
+            startup.create_task(db.connect())
+            startup.create_task(telegram_bot.initialize())
+    except BaseException:
+        await telegram_bot.abort()
+        await db.close()
+        raise
     
     # Start background tasks
     asyncio.create_task(storage_manager.start_file_refresh_task())
+    activity_flusher = asyncio.create_task(db.start_activity_flusher())
     
     logger.info("Application started successfully")
     yield
@@ -76,7 +145,13 @@ async def lifespan(app: FastAPI):
     # Shutdown
     if telegram_bot:
         await telegram_bot.stop()
+    activity_flusher.cancel()
+    with suppress(asyncio.CancelledError):
+        await activity_flusher
+    if storage_manager:
+        await storage_manager.close()
     if db:
+        await db.flush_activities()
         await db.close()
     logger.info("Application shutdown complete")
 
@@ -84,18 +159,63 @@ app = FastAPI(
     title="EduLearn Miniapp System",
     description="Complete Educational Telegram Miniapp with Admin Panel",
     version="1.0.0",
+    default_response_class=MongoJSONResponse,
     lifespan=lifespan
 )
 
 # Add CORS middleware
+# Explicit origins: a wildcard cannot be combined with credentials, and
+# max_age lets browsers reuse the preflight result for a day
+cors_origins = ["https://web.telegram.org", "https://t.me", os.getenv("ADMIN_ORIGIN", "")]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[origin for origin in cors_origins if origin],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["authorization", "content-type"],
+    max_age=86400,
 )
 
+# Compress JSON/HTML responses; video and PDF streams are sent as-is
+app.add_middleware(
+    MediaAwareGZipMiddleware,
+    excluded_prefixes=("/api/miniapp/stream/",),
+    minimum_size=1024,
+    compresslevel=5
+)
+
+# Per-route request count and latency metrics for Prometheus. /metrics is only
+# exposed when METRICS_TOKEN is set, and scrapers must send it as a bearer token
+instrumentator = Instrumentator().instrument(app)
+metrics_token = os.getenv("METRICS_TOKEN")
+
+def require_metrics_token(request: Request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), metrics_token.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+if metrics_token:
+    instrumentator.expose(
+        app,
+        endpoint="/metrics",
+        include_in_schema=False,
+        dependencies=[Depends(require_metrics_token)]
+    )
+
+# Sampling profiler, only when PROFILE is set: append ?profile to any URL
+if os.getenv("PROFILE"):
+    from pyinstrument import Profiler
+    
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        if "profile" not in request.query_params:
+            return await call_next(request)
+        profiler = Profiler(interval=0.01, async_mode="enabled")
+        profiler.start()
+        await call_next(request)
+        profiler.stop()
+        return HTMLResponse(profiler.output_html())
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
@@ -105,7 +225,7 @@ security = HTTPBearer(auto_error=False)
 # Health check endpoint
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return mongo_json({"status": "healthy", "timestamp": datetime.utcnow()})
 
 # Telegram webhook endpoint
 @app.post("/telegram/webhook")
@@ -125,19 +245,19 @@ async def miniapp_page(request: Request, user_id: str = None):
 
 @app.get("/api/miniapp/init")
 async def miniapp_init(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await miniapp_handler.initialize_user(request, credentials)
+    return mongo_json(await miniapp_handler.initialize_user(request, credentials))
 
 @app.get("/api/miniapp/apps")
 async def get_apps(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await miniapp_handler.get_apps(credentials)
+    return mongo_json(await miniapp_handler.get_apps(credentials))
 
 @app.get("/api/miniapp/courses/{app_id}")
 async def get_courses(app_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await miniapp_handler.get_courses(app_id, credentials)
+    return mongo_json(await miniapp_handler.get_courses(app_id, credentials))
 
 @app.get("/api/miniapp/content/{course_id}")
 async def get_course_content(course_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await miniapp_handler.get_course_content(course_id, credentials)
+    return mongo_json(await miniapp_handler.get_course_content(course_id, credentials))
 
 @app.get("/api/miniapp/stream/video/{file_id}")
 async def stream_video(file_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -149,7 +269,7 @@ async def stream_pdf(file_id: str, credentials: HTTPAuthorizationCredentials = D
 
 @app.post("/api/miniapp/log-activity")
 async def log_activity(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await miniapp_handler.log_activity(request, credentials)
+    return mongo_json(await miniapp_handler.log_activity(request, credentials))
 
 # Admin Panel endpoints
 @app.get("/admin", response_class=HTMLResponse)
@@ -158,7 +278,7 @@ async def admin_login_page(request: Request):
 
 @app.post("/admin/login")
 async def admin_login(request: Request):
-    return await admin_handler.login(request)
+    return mongo_json(await admin_handler.login(request))
 
 @app.get("/admin/dashboard", response_class=HTMLResponse)
 async def admin_dashboard(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -166,71 +286,71 @@ async def admin_dashboard(request: Request, credentials: HTTPAuthorizationCreden
 
 @app.get("/api/admin/stats")
 async def get_admin_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.get_stats(credentials)
+    return mongo_json(await admin_handler.get_stats(credentials))
 
 @app.get("/api/admin/users")
 async def get_users(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.get_users(credentials)
+    return mongo_json(await admin_handler.get_users(credentials))
 
 @app.post("/api/admin/users/{user_id}/ban")
-async def ban_user(user_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.ban_user(user_id, credentials)
+async def ban_user(user_id: ObjectIdStr, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.ban_user(user_id, credentials))
 
 @app.post("/api/admin/users/{user_id}/unban")
-async def unban_user(user_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.unban_user(user_id, credentials)
+async def unban_user(user_id: ObjectIdStr, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.unban_user(user_id, credentials))
 
 @app.post("/api/admin/users/{user_id}/reset-device")
-async def reset_user_device(user_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.reset_user_device(user_id, credentials)
+async def reset_user_device(user_id: ObjectIdStr, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.reset_user_device(user_id, credentials))
 
 @app.post("/api/admin/users/{user_id}/assign-course")
-async def assign_course(user_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.assign_course(user_id, request, credentials)
+async def assign_course(user_id: ObjectIdStr, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.assign_course(user_id, request, credentials))
 
 @app.get("/api/admin/apps")
 async def get_admin_apps(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.get_apps(credentials)
+    return mongo_json(await admin_handler.get_apps(credentials))
 
 @app.post("/api/admin/apps")
 async def create_app(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.create_app(request, credentials)
+    return mongo_json(await admin_handler.create_app(request, credentials))
 
 @app.put("/api/admin/apps/{app_id}")
-async def update_app(app_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.update_app(app_id, request, credentials)
+async def update_app(app_id: ObjectIdStr, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.update_app(app_id, request, credentials))
 
 @app.delete("/api/admin/apps/{app_id}")
-async def delete_app(app_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.delete_app(app_id, credentials)
+async def delete_app(app_id: ObjectIdStr, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.delete_app(app_id, credentials))
 
 @app.get("/api/admin/courses")
 async def get_admin_courses(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.get_courses(credentials)
+    return mongo_json(await admin_handler.get_courses(credentials))
 
 @app.post("/api/admin/courses")
 async def create_course(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.create_course(request, credentials)
+    return mongo_json(await admin_handler.create_course(request, credentials))
 
 @app.put("/api/admin/courses/{course_id}")
-async def update_course(course_id: str, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.update_course(course_id, request, credentials)
+async def update_course(course_id: ObjectIdStr, request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.update_course(course_id, request, credentials))
 
 @app.delete("/api/admin/courses/{course_id}")
-async def delete_course(course_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.delete_course(course_id, credentials)
+async def delete_course(course_id: ObjectIdStr, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.delete_course(course_id, credentials))
 
 @app.get("/api/admin/media")
 async def get_media_files(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.get_media_files(credentials)
+    return mongo_json(await admin_handler.get_media_files(credentials))
 
 @app.post("/api/admin/sync-channel")
 async def sync_channel(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.sync_channel(request, credentials)
+    return mongo_json(await admin_handler.sync_channel(request, credentials))
 
 @app.get("/api/admin/user-activity/{user_id}")
-async def get_user_activity(user_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
-    return await admin_handler.get_user_activity(user_id, credentials)
+async def get_user_activity(user_id: ObjectIdStr, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return mongo_json(await admin_handler.get_user_activity(user_id, credentials))
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
@@ -238,5 +358,11 @@ if __name__ == "__main__":
         "app:app",
         host="0.0.0.0",
         port=port,
-        reload=False
+        loop="uvloop",
+        http="httptools",
+        reload=False,
+        # Each worker runs lifespan: webhook registration and index builds are
+        # idempotent, the file refresh loop is gated by a Mongo lease, and the
+        # in-process caches are per worker, each bounded by its own TTL
+        workers=int(os.getenv("WEB_CONCURRENCY", 1))
     )
\ No newline at end of file
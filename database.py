@@ -1,24 +1,116 @@
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING, DESCENDING
+try:
+    # Native asyncio driver (PyMongo 4.9+), no thread pool in between
+    from pymongo import AsyncMongoClient
+except ImportError:
+    from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from pymongo import monitoring
+import bson
 from bson import ObjectId
+from bson.errors import InvalidDocument
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator
+from cachetools import TTLCache
+import asyncio
+import hashlib
+import inspect
 import os
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on documents materialized by list queries without their own limit
+MAX_LIST_LENGTH = 1000
+
+# Seconds the active app catalog and per-app course lists are served from memory
+APPS_CACHE_TTL = 30
+COURSES_CACHE_TTL = 15
+
+# Tries per activity batch before it is handed back to the queue
+ACTIVITY_WRITE_ATTEMPTS = 3
+
+class SlowCommandLogger(monitoring.CommandListener):
+    """Log Mongo commands that take longer than threshold_ms"""
+    def __init__(self, threshold_ms: float):
+        self.threshold_ms = threshold_ms
+    
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        duration_ms = event.duration_micros / 1000
+        if duration_ms >= self.threshold_ms:
+            logger.warning(f"Slow Mongo command {event.command_name} on {event.database_name}: {duration_ms:.1f} ms")
+    
+    def failed(self, event):
+        logger.warning(f"Mongo command {event.command_name} failed after {event.duration_micros / 1000:.1f} ms: {event.failure}")
+
+def stamped_update(update_data: Dict[str, Any], field: str = 'updated_at') -> Dict[str, Any]:
+    """Build an update document whose timestamp field is set by the server"""
+    update = {"$currentDate": {field: {"$type": "date"}}}
+    if update_data:
+        update["$set"] = update_data
+    return update
+
+def with_str_ids(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Stringify each document's _id in place
+    
+    Every getter hands out _id as a str, the form the ids are stored in
+    when used as foreign keys (user_courses.user_id and friends).
+    """
+    for doc in docs:
+        if '_id' in doc:
+            doc['_id'] = str(doc['_id'])
+    return docs
+
+def copy_docs(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Shallow-copy a list of documents so callers can't mutate a cached one"""
+    return [dict(doc) for doc in docs]
+
+def as_object_id(value) -> ObjectId:
+    """Return value as an ObjectId, parsing only when given a string"""
+    return value if isinstance(value, ObjectId) else ObjectId(value)
+
 class Database:
     def __init__(self):
         self.client = None
         self.db = None
         self.mongodb_url = os.getenv('MONGODB_URL', 'mongodb://localhost:27017')
         self.database_name = os.getenv('DATABASE_NAME', 'edulearn_miniapp')
+        # Short-lived cache of admin sessions keyed by token digest
+        self._session_cache = TTLCache(maxsize=10_000, ttl=30)
+        # Bumped on logout so reads that raced the delete don't re-cache the session
+        self._session_generation = 0
+        # Read-mostly catalog caches: the active app list, and course lists keyed by app_id
+        self._apps_cache = TTLCache(maxsize=1, ttl=APPS_CACHE_TTL)
+        self._courses_cache = TTLCache(maxsize=1024, ttl=COURSES_CACHE_TTL)
+        # Bumped on catalog writes so reads that raced them are not cached
+        self._apps_generation = 0
+        self._courses_generation = 0
+        # Enrollment checks keyed by (user_id, course_id)
+        self._enrollment_cache = TTLCache(maxsize=20_000, ttl=30)
+        # Bumped on every enrollment write so racing reads don't cache stale results
+        self._enrollment_generation = 0
+        # Activities waiting to be written in batches by start_activity_flusher
+        self._activity_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
         
     async def connect(self):
         """Connect to MongoDB"""
         try:
-            self.client = AsyncIOMotorClient(self.mongodb_url)
+            self.client = AsyncMongoClient(
+                self.mongodb_url,
+                maxPoolSize=int(os.getenv('MONGO_POOL_MAX', 200)),
+                minPoolSize=int(os.getenv('MONGO_POOL_MIN', 20)),
+                maxIdleTimeMS=60_000,
+                waitQueueTimeoutMS=2500,
+                serverSelectionTimeoutMS=3_000,
+                socketTimeoutMS=10_000,
+                retryWrites=True,
+                # Unavailable compressors are skipped by the driver with a warning
+                compressors=os.getenv('MONGO_COMPRESSORS', 'zstd,snappy'),
+                event_listeners=[SlowCommandLogger(float(os.getenv('MONGO_SLOW_MS', 100)))]
+            )
             self.db = self.client[self.database_name]
             
             # Test connection
@@ -35,69 +127,140 @@ class Database:
     async def close(self):
         """Close database connection"""
         if self.client:
-            self.client.close()
+            # PyMongo's async client closes asynchronously, Motor's does not
+            result = self.client.close()
+            if inspect.isawaitable(result):
+                await result
             logger.info("Database connection closed")
     
     async def create_indexes(self):
-        """Create necessary database indexes"""
-        try:
+        """Create necessary database indexes
+        
+        Index builds are independent, so they are issued concurrently and
+        a failing one does not stop the rest.
+        """
+        results = await asyncio.gather(
             # Users collection indexes
-            await self.db.users.create_index("telegram_id", unique=True)
-            await self.db.users.create_index("device_fingerprint")
-            await self.db.users.create_index("is_banned")
+            self.db.users.create_index("telegram_id", unique=True),
+            self.db.users.create_index("device_fingerprint"),
+            self.db.users.create_index("is_banned"),
+            self.db.users.create_index([("last_activity", DESCENDING)]),
+            self.db.users.create_index([("created_at", DESCENDING)]),
             
             # Apps collection indexes
-            await self.db.apps.create_index("name")
-            await self.db.apps.create_index("is_active")
+            self.db.apps.create_index("name"),
+            self.db.apps.create_index("is_active"),
             
             # Courses collection indexes
-            await self.db.courses.create_index("app_id")
-            await self.db.courses.create_index("course_id", unique=True)
-            await self.db.courses.create_index("is_active")
+            self.db.courses.create_index("app_id"),
+            self.db.courses.create_index("course_id", unique=True),
+            self.db.courses.create_index("is_active"),
+            self.db.courses.create_index([("app_id", ASCENDING), ("is_active", ASCENDING), ("name", ASCENDING)]),
             
             # User courses collection indexes
-            await self.db.user_courses.create_index([("user_id", ASCENDING), ("course_id", ASCENDING)], unique=True)
+            self.db.user_courses.create_index([("user_id", ASCENDING), ("course_id", ASCENDING)], unique=True),
+            self.db.user_courses.create_index([("user_id", ASCENDING), ("is_active", ASCENDING)]),
+            self.db.user_courses.create_index([("user_id", ASCENDING), ("course_id", ASCENDING), ("is_active", ASCENDING)]),
             
             # Media files collection indexes
-            await self.db.media_files.create_index("course_id")
-            await self.db.media_files.create_index("file_type")
-            await self.db.media_files.create_index("telegram_file_id")
-            await self.db.media_files.create_index("reference_id", unique=True)
+            self.db.media_files.create_index("course_id"),
+            self.db.media_files.create_index("file_type"),
+            self.db.media_files.create_index("telegram_file_id"),
+            self.db.media_files.create_index("reference_id", unique=True),
+            self.db.media_files.create_index([("course_id", ASCENDING), ("file_type", ASCENDING), ("order", ASCENDING)]),
             
             # Channel mappings collection indexes
-            await self.db.channel_mappings.create_index("channel_id", unique=True)
-            await self.db.channel_mappings.create_index("course_id")
+            self.db.channel_mappings.create_index("channel_id", unique=True),
+            self.db.channel_mappings.create_index("course_id"),
             
             # User activities collection indexes
-            await self.db.user_activities.create_index([("user_id", ASCENDING), ("timestamp", DESCENDING)])
-            await self.db.user_activities.create_index("activity_type")
+            self.db.user_activities.create_index([("user_id", ASCENDING), ("timestamp", DESCENDING)]),
+            self.db.user_activities.create_index("activity_type"),
             
             # Admin sessions collection indexes
-            await self.db.admin_sessions.create_index("token", unique=True)
-            await self.db.admin_sessions.create_index("expires_at")
+            self.db.admin_sessions.create_index("token", unique=True),
+            # TTL index: Mongo removes sessions once expires_at has passed
+            self._ensure_ttl_index(self.db.admin_sessions, "expires_at"),
             
             # File references collection indexes
-            await self.db.file_references.create_index("reference_id", unique=True)
-            await self.db.file_references.create_index("telegram_file_id")
-            await self.db.file_references.create_index("last_refreshed")
-            
+            self.db.file_references.create_index("reference_id", unique=True),
+            self.db.file_references.create_index("telegram_file_id"),
+            self.db.file_references.create_index("last_refreshed"),
+            return_exceptions=True
+        )
+        
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logger.error(f"Error creating index: {error}")
+        if not errors:
             logger.info("Database indexes created successfully")
-            
-        except Exception as e:
-            logger.error(f"Error creating indexes: {e}")
+    
+    async def _ensure_ttl_index(self, collection, field: str):
+        """Create a TTL index on field, converting an existing plain index
+        
+        Older deployments have a regular ascending index on field, which
+        makes create_index fail with IndexOptionsConflict. That index is
+        switched to TTL with collMod, or dropped and rebuilt on servers
+        that cannot modify it in place.
+        """
+        try:
+            return await collection.create_index(field, expireAfterSeconds=0)
+        except OperationFailure as e:
+            if e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+                raise
+        
+        logger.info(f"Converting {collection.name}.{field} index to a TTL index")
+        try:
+            await self.db.command(
+                "collMod", collection.name,
+                index={"keyPattern": {field: 1}, "expireAfterSeconds": 0}
+            )
+        except OperationFailure:
+            await collection.drop_index([(field, ASCENDING)])
+            return await collection.create_index(field, expireAfterSeconds=0)
+        return f"{field}_1"
     
     # Users operations
     async def create_user(self, user_data: Dict[str, Any]) -> str:
         """Create new user"""
-        user_data['created_at'] = datetime.utcnow()
-        user_data['updated_at'] = datetime.utcnow()
+        now = datetime.utcnow()
+        user_data['created_at'] = now
+        user_data['updated_at'] = now
         user_data['is_banned'] = False
         user_data['device_reset_count'] = 0
-        user_data['last_activity'] = datetime.utcnow()
+        user_data['last_activity'] = now
         
         result = await self.db.users.insert_one(user_data)
         return str(result.inserted_id)
     
+    async def upsert_user_on_start(self, telegram_id: str,
+                                   defaults: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        """Fetch a user and touch last_activity, creating them if missing
+        
+        One round trip for the /start flow. defaults only apply to a new
+        user. Returns the user and whether it was just created.
+        """
+        # BSON dates hold milliseconds; truncate so created_at compares equal
+        now = datetime.utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        # last_activity/created_at come from Python: created_at == now is how a
+        # fresh insert is told apart. updated_at is stamped by the server.
+        update = stamped_update({"last_activity": now})
+        update["$setOnInsert"] = {
+            **defaults,
+            "created_at": now,
+            "is_banned": False,
+            "device_reset_count": 0
+        }
+        user = await self.db.users.find_one_and_update(
+            {"telegram_id": telegram_id},
+            update,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        user['_id'] = str(user['_id'])
+        return user, user.get('created_at') == now
+    
     async def get_user_by_telegram_id(self, telegram_id: str) -> Optional[Dict[str, Any]]:
         """Get user by telegram ID"""
         user = await self.db.users.find_one({"telegram_id": telegram_id})
@@ -107,17 +270,16 @@ class Database:
     
     async def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
-        user = await self.db.users.find_one({"_id": ObjectId(user_id)})
+        user = await self.db.users.find_one({"_id": as_object_id(user_id)})
         if user:
             user['_id'] = str(user['_id'])
         return user
     
     async def update_user(self, user_id: str, update_data: Dict[str, Any]) -> bool:
         """Update user data"""
-        update_data['updated_at'] = datetime.utcnow()
         result = await self.db.users.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": update_data}
+            {"_id": as_object_id(user_id)},
+            stamped_update(update_data)
         )
         return result.modified_count > 0
     
@@ -143,81 +305,109 @@ class Database:
         
         return await self.update_user(user_id, update_data)
     
-    async def get_users(self, skip: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
+    async def get_users(self, skip: int = 0, limit: int = 50,
+                        projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """Get paginated list of users"""
-        cursor = self.db.users.find().sort("created_at", DESCENDING).skip(skip).limit(limit)
-        users = []
-        async for user in cursor:
-            user['_id'] = str(user['_id'])
-            users.append(user)
-        return users
+        cursor = self.db.users.find({}, projection=projection).sort("created_at", DESCENDING).skip(skip).limit(limit)
+        return with_str_ids(await cursor.to_list(length=limit or MAX_LIST_LENGTH))
     
     # Apps operations
     async def create_app(self, app_data: Dict[str, Any]) -> str:
         """Create new app"""
-        app_data['created_at'] = datetime.utcnow()
-        app_data['updated_at'] = datetime.utcnow()
+        now = datetime.utcnow()
+        app_data['created_at'] = now
+        app_data['updated_at'] = now
         app_data['is_active'] = True
         
         result = await self.db.apps.insert_one(app_data)
+        self._invalidate_apps()
         return str(result.inserted_id)
     
-    async def get_apps(self, active_only: bool = True) -> List[Dict[str, Any]]:
-        """Get all apps"""
+    async def get_apps(self, active_only: bool = True,
+                       projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Get all apps
+        
+        The active catalog is served from memory for APPS_CACHE_TTL seconds;
+        callers get their own copy of each document.
+        """
+        cacheable = active_only and projection is None
+        cached = self._apps_cache.get('active') if cacheable else None
+        if cached is not None:
+            return copy_docs(cached)
+        
+        generation = self._apps_generation
         filter_query = {"is_active": True} if active_only else {}
-        cursor = self.db.apps.find(filter_query).sort("name", ASCENDING)
-        apps = []
-        async for app in cursor:
-            app['_id'] = str(app['_id'])
-            apps.append(app)
+        cursor = self.db.apps.find(filter_query, projection=projection).sort("name", ASCENDING)
+        apps = with_str_ids(await cursor.to_list(length=MAX_LIST_LENGTH))
+        # Skip caching if an app was written while the query was in flight
+        if cacheable and generation == self._apps_generation:
+            self._apps_cache['active'] = copy_docs(apps)
         return apps
     
     async def get_app_by_id(self, app_id: str) -> Optional[Dict[str, Any]]:
         """Get app by ID"""
-        app = await self.db.apps.find_one({"_id": ObjectId(app_id)})
+        app = await self.db.apps.find_one({"_id": as_object_id(app_id)})
         if app:
             app['_id'] = str(app['_id'])
         return app
     
     async def update_app(self, app_id: str, update_data: Dict[str, Any]) -> bool:
         """Update app"""
-        update_data['updated_at'] = datetime.utcnow()
         result = await self.db.apps.update_one(
-            {"_id": ObjectId(app_id)},
-            {"$set": update_data}
+            {"_id": as_object_id(app_id)},
+            stamped_update(update_data)
         )
+        self._invalidate_apps()
         return result.modified_count > 0
     
     async def delete_app(self, app_id: str) -> bool:
         """Soft delete app"""
         return await self.update_app(app_id, {"is_active": False})
     
+    def _invalidate_apps(self):
+        """Drop the cached app catalog; call after the write has completed"""
+        self._apps_generation += 1
+        self._apps_cache.clear()
+    
     # Courses operations
     async def create_course(self, course_data: Dict[str, Any]) -> str:
         """Create new course"""
-        course_data['created_at'] = datetime.utcnow()
-        course_data['updated_at'] = datetime.utcnow()
+        now = datetime.utcnow()
+        course_data['created_at'] = now
+        course_data['updated_at'] = now
         course_data['is_active'] = True
         
         result = await self.db.courses.insert_one(course_data)
+        self._invalidate_courses()
         return str(result.inserted_id)
     
-    async def get_courses_by_app(self, app_id: str, active_only: bool = True) -> List[Dict[str, Any]]:
-        """Get courses by app ID"""
+    async def get_courses_by_app(self, app_id: str, active_only: bool = True,
+                                 projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Get courses by app ID
+        
+        Active course lists are served from memory for COURSES_CACHE_TTL
+        seconds; callers get their own copy of each document.
+        """
+        cacheable = active_only and projection is None
+        cached = self._courses_cache.get(app_id) if cacheable else None
+        if cached is not None:
+            return copy_docs(cached)
+        
+        generation = self._courses_generation
         filter_query = {"app_id": app_id}
         if active_only:
             filter_query["is_active"] = True
         
-        cursor = self.db.courses.find(filter_query).sort("name", ASCENDING)
-        courses = []
-        async for course in cursor:
-            course['_id'] = str(course['_id'])
-            courses.append(course)
+        cursor = self.db.courses.find(filter_query, projection=projection).sort("name", ASCENDING)
+        courses = with_str_ids(await cursor.to_list(length=MAX_LIST_LENGTH))
+        # Skip caching if a course was written while the query was in flight
+        if cacheable and generation == self._courses_generation:
+            self._courses_cache[app_id] = copy_docs(courses)
         return courses
     
     async def get_course_by_id(self, course_id: str) -> Optional[Dict[str, Any]]:
         """Get course by ID"""
-        course = await self.db.courses.find_one({"_id": ObjectId(course_id)})
+        course = await self.db.courses.find_one({"_id": as_object_id(course_id)})
         if course:
             course['_id'] = str(course['_id'])
         return course
@@ -231,30 +421,43 @@ class Database:
     
     async def update_course(self, course_id: str, update_data: Dict[str, Any]) -> bool:
         """Update course"""
-        update_data['updated_at'] = datetime.utcnow()
         result = await self.db.courses.update_one(
-            {"_id": ObjectId(course_id)},
-            {"$set": update_data}
+            {"_id": as_object_id(course_id)},
+            stamped_update(update_data)
         )
+        self._invalidate_courses()
         return result.modified_count > 0
     
     async def delete_course(self, course_id: str) -> bool:
         """Soft delete course"""
         return await self.update_course(course_id, {"is_active": False})
     
+    def _invalidate_courses(self):
+        """Drop the cached course lists; call after the write has completed"""
+        self._courses_generation += 1
+        self._courses_cache.clear()
+    
     # User courses operations
     async def assign_course_to_user(self, user_id: str, course_id: str) -> bool:
-        """Assign course to user"""
+        """Assign course to user
+        
+        Idempotent: re-assigning an existing enrollment reactivates it.
+        """
         try:
-            await self.db.user_courses.insert_one({
-                "user_id": user_id,
-                "course_id": course_id,
-                "assigned_at": datetime.utcnow(),
-                "is_active": True
-            })
-            return True
-        except:
-            return False
+            result = await self.db.user_courses.update_one(
+                {"user_id": user_id, "course_id": course_id},
+                {
+                    "$set": {"is_active": True},
+                    "$setOnInsert": {"assigned_at": datetime.utcnow()}
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert created the enrollment first
+            result = None
+        finally:
+            self._invalidate_enrollment(user_id, course_id)
+        return result is None or result.upserted_id is not None or result.matched_count > 0
     
     async def remove_course_from_user(self, user_id: str, course_id: str) -> bool:
         """Remove course assignment from user"""
@@ -262,6 +465,7 @@ class Database:
             "user_id": user_id,
             "course_id": course_id
         })
+        self._invalidate_enrollment(user_id, course_id)
         return result.deleted_count > 0
     
     async def get_user_courses(self, user_id: str) -> List[Dict[str, Any]]:
@@ -277,47 +481,72 @@ class Database:
                 }
             },
             {"$unwind": "$course_info"},
-            {"$match": {"course_info.is_active": True}}
+            {"$match": {"course_info.is_active": True}},
+            # Ship only the course document, not the enrollment wrapper
+            {"$replaceRoot": {"newRoot": "$course_info"}}
         ]
         
         cursor = self.db.user_courses.aggregate(pipeline)
-        courses = []
-        async for doc in cursor:
-            course = doc['course_info']
-            course['_id'] = str(course['_id'])
-            courses.append(course)
-        return courses
+        if inspect.isawaitable(cursor):
+            # PyMongo's async aggregate is a coroutine returning the cursor
+            cursor = await cursor
+        return with_str_ids(await cursor.to_list(length=MAX_LIST_LENGTH))
     
     async def is_user_enrolled_in_course(self, user_id: str, course_id: str) -> bool:
         """Check if user is enrolled in course"""
-        doc = await self.db.user_courses.find_one({
+        key = (user_id, course_id)
+        enrolled = self._enrollment_cache.get(key)
+        if enrolled is not None:
+            return enrolled
+        
+        generation = self._enrollment_generation
+        count = await self.db.user_courses.count_documents({
             "user_id": user_id,
             "course_id": course_id,
             "is_active": True
-        })
-        return doc is not None
+        }, limit=1)
+        enrolled = count > 0
+        # Skip caching if an enrollment changed while the count was in flight
+        if generation == self._enrollment_generation:
+            self._enrollment_cache[key] = enrolled
+        return enrolled
+    
+    def _invalidate_enrollment(self, user_id: str, course_id: str):
+        """Drop a cached enrollment check; call after the write has completed"""
+        self._enrollment_generation += 1
+        self._enrollment_cache.pop((user_id, course_id), None)
     
     # Media files operations
     async def create_media_file(self, media_data: Dict[str, Any]) -> str:
         """Create media file record"""
-        media_data['created_at'] = datetime.utcnow()
-        media_data['updated_at'] = datetime.utcnow()
+        now = datetime.utcnow()
+        media_data['created_at'] = now
+        media_data['updated_at'] = now
         
         result = await self.db.media_files.insert_one(media_data)
         return str(result.inserted_id)
     
-    async def get_course_media_files(self, course_id: str, file_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    async def bulk_create_media_files(self, media_files: List[Dict[str, Any]]) -> int:
+        """Create several media file records with one insert_many"""
+        if not media_files:
+            return 0
+        now = datetime.utcnow()
+        for media_data in media_files:
+            media_data['created_at'] = now
+            media_data['updated_at'] = now
+        
+        result = await self.db.media_files.insert_many(media_files, ordered=False)
+        return len(result.inserted_ids)
+    
+    async def get_course_media_files(self, course_id: str, file_type: Optional[str] = None,
+                                     projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """Get media files for course"""
         filter_query = {"course_id": course_id}
         if file_type:
             filter_query["file_type"] = file_type
         
-        cursor = self.db.media_files.find(filter_query).sort("order", ASCENDING)
-        files = []
-        async for file in cursor:
-            file['_id'] = str(file['_id'])
-            files.append(file)
-        return files
+        cursor = self.db.media_files.find(filter_query, projection=projection).sort("order", ASCENDING)
+        return with_str_ids(await cursor.to_list(length=MAX_LIST_LENGTH))
     
     async def get_media_file_by_reference_id(self, reference_id: str) -> Optional[Dict[str, Any]]:
         """Get media file by reference ID"""
@@ -328,18 +557,18 @@ class Database:
     
     async def update_media_file(self, file_id: str, update_data: Dict[str, Any]) -> bool:
         """Update media file"""
-        update_data['updated_at'] = datetime.utcnow()
         result = await self.db.media_files.update_one(
-            {"_id": ObjectId(file_id)},
-            {"$set": update_data}
+            {"_id": as_object_id(file_id)},
+            stamped_update(update_data)
         )
         return result.modified_count > 0
     
     # Channel mappings operations
     async def create_channel_mapping(self, mapping_data: Dict[str, Any]) -> str:
         """Create channel mapping"""
-        mapping_data['created_at'] = datetime.utcnow()
-        mapping_data['last_synced'] = datetime.utcnow()
+        now = datetime.utcnow()
+        mapping_data['created_at'] = now
+        mapping_data['last_synced'] = now
         
         result = await self.db.channel_mappings.insert_one(mapping_data)
         return str(result.inserted_id)
@@ -355,29 +584,111 @@ class Database:
         """Update channel last sync time"""
         result = await self.db.channel_mappings.update_one(
             {"channel_id": channel_id},
-            {"$set": {"last_synced": datetime.utcnow()}}
+            stamped_update({}, 'last_synced')
         )
         return result.modified_count > 0
     
     # User activity operations
     async def log_user_activity(self, activity_data: Dict[str, Any]) -> str:
-        """Log user activity"""
+        """Log user activity
+        
+        The activity is queued and written by start_activity_flusher; the ID
+        is assigned up front so it can be returned immediately.
+        """
+        activity_data['_id'] = ObjectId()
         activity_data['timestamp'] = datetime.utcnow()
         
-        result = await self.db.user_activities.insert_one(activity_data)
-        return str(result.inserted_id)
+        try:
+            self._activity_queue.put_nowait(activity_data)
+        except asyncio.QueueFull:
+            await self.db.user_activities.insert_one(activity_data)
+        return str(activity_data['_id'])
+    
+    async def start_activity_flusher(self, batch_size: int = 500, interval: float = 0.5):
+        """Background task writing queued activities with insert_many"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self._activity_queue.get()]
+            try:
+                deadline = loop.time() + interval
+                while len(batch) < batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._activity_queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                # Also runs on cancellation so a half-collected batch is not lost
+                await self._insert_activities(batch)
+    
+    async def flush_activities(self):
+        """Write any activities still queued"""
+        batch = []
+        while not self._activity_queue.empty():
+            batch.append(self._activity_queue.get_nowait())
+        if batch:
+            await self._insert_activities(batch)
+    
+    async def _insert_activities(self, batch: List[Dict[str, Any]]):
+        """Write a batch of queued activities, retrying transient failures
+        
+        Activities get their _id in log_user_activity, so a retry after a
+        partial write only raises duplicate keys for the ones already
+        stored. A batch that keeps failing goes back on the queue.
+        """
+        attempt = 0
+        while batch:
+            try:
+                await self.db.user_activities.insert_many(batch, ordered=False)
+                return
+            except BulkWriteError as e:
+                # ordered=False: everything except the reported documents was written
+                failed = [error for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+                if failed:
+                    logger.error(f"Dropped {len(failed)} of {len(batch)} user activities: {failed[0].get('errmsg')}")
+                return
+            except InvalidDocument as e:
+                # Nothing was sent; retry without the documents BSON cannot encode
+                encodable = [activity for activity in batch if self._is_encodable(activity)]
+                logger.error(f"Dropped {len(batch) - len(encodable)} unencodable user activities: {e}")
+                batch = encodable
+            except PyMongoError as e:
+                attempt += 1
+                logger.warning(f"Writing {len(batch)} user activities failed (attempt {attempt}): {e}")
+                if attempt >= ACTIVITY_WRITE_ATTEMPTS:
+                    break
+                await asyncio.sleep(2 ** (attempt - 1))
+        
+        requeued = 0
+        for activity in batch:
+            try:
+                self._activity_queue.put_nowait(activity)
+            except asyncio.QueueFull:
+                break
+            requeued += 1
+        if batch:
+            logger.error(f"Re-queued {requeued} of {len(batch)} user activities after repeated write failures")
+    
+    @staticmethod
+    def _is_encodable(document: Dict[str, Any]) -> bool:
+        try:
+            bson.encode(document)
+        except InvalidDocument:
+            return False
+        return True
     
-    async def get_user_activities(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+    async def get_user_activities(self, user_id: str, limit: int = 100,
+                                  projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """Get user activities"""
         cursor = self.db.user_activities.find(
-            {"user_id": user_id}
+            {"user_id": user_id},
+            projection=projection
         ).sort("timestamp", DESCENDING).limit(limit)
         
-        activities = []
-        async for activity in cursor:
-            activity['_id'] = str(activity['_id'])
-            activities.append(activity)
-        return activities
+        return with_str_ids(await cursor.to_list(length=limit or MAX_LIST_LENGTH))
     
     # Admin session operations
     async def create_admin_session(self, session_data: Dict[str, Any]) -> str:
@@ -387,27 +698,64 @@ class Database:
         result = await self.db.admin_sessions.insert_one(session_data)
         return str(result.inserted_id)
     
+    @staticmethod
+    def _session_key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+    
     async def get_admin_session(self, token: str) -> Optional[Dict[str, Any]]:
-        """Get admin session by token"""
-        session = await self.db.admin_sessions.find_one({"token": token})
-        if session:
+        """Get admin session by token
+        
+        Expired sessions are treated as missing, whether they come from the
+        cache or from a document the TTL monitor has not removed yet. The
+        caller gets its own copy of the session.
+        """
+        key = self._session_key(token)
+        session = self._session_cache.get(key)
+        if session is None:
+            generation = self._session_generation
+            session = await self.db.admin_sessions.find_one({"token": token})
+            if not session:
+                return None
             session['_id'] = str(session['_id'])
-        return session
+            # Skip caching if a session was deleted while the read was in flight
+            if generation == self._session_generation:
+                self._session_cache[key] = dict(session)
+        
+        expires_at = session.get('expires_at')
+        if expires_at and expires_at <= datetime.utcnow():
+            self._session_cache.pop(key, None)
+            return None
+        return dict(session)
     
     async def delete_admin_session(self, token: str) -> bool:
         """Delete admin session"""
         result = await self.db.admin_sessions.delete_one({"token": token})
+        self._session_generation += 1
+        self._session_cache.pop(self._session_key(token), None)
         return result.deleted_count > 0
     
     # File reference operations
     async def create_file_reference(self, reference_data: Dict[str, Any]) -> str:
         """Create file reference for auto-refresh system"""
-        reference_data['created_at'] = datetime.utcnow()
-        reference_data['last_refreshed'] = datetime.utcnow()
+        now = datetime.utcnow()
+        reference_data['created_at'] = now
+        reference_data['last_refreshed'] = now
         
         result = await self.db.file_references.insert_one(reference_data)
         return str(result.inserted_id)
     
+    async def bulk_create_file_references(self, references: List[Dict[str, Any]]) -> int:
+        """Create several file references with one insert_many"""
+        if not references:
+            return 0
+        now = datetime.utcnow()
+        for reference_data in references:
+            reference_data['created_at'] = now
+            reference_data['last_refreshed'] = now
+        
+        result = await self.db.file_references.insert_many(references, ordered=False)
+        return len(result.inserted_ids)
+    
     async def get_file_reference(self, reference_id: str) -> Optional[Dict[str, Any]]:
         """Get file reference by reference ID"""
         ref = await self.db.file_references.find_one({"reference_id": reference_id})
@@ -417,25 +765,41 @@ class Database:
     
     async def update_file_reference(self, reference_id: str, update_data: Dict[str, Any]) -> bool:
         """Update file reference"""
-        update_data['last_refreshed'] = datetime.utcnow()
         result = await self.db.file_references.update_one(
             {"reference_id": reference_id},
-            {"$set": update_data}
+            stamped_update(update_data, 'last_refreshed')
         )
         return result.modified_count > 0
     
-    async def get_expired_file_references(self, hours: int = 23) -> List[Dict[str, Any]]:
-        """Get file references that need refresh"""
+    async def bulk_update_file_references(self, updates: List[Tuple[str, Dict[str, Any]]]) -> int:
+        """Apply (reference_id, update_data) pairs in a single bulk write"""
+        if not updates:
+            return 0
+        operations = [
+            UpdateOne({"reference_id": reference_id}, stamped_update(update_data, 'last_refreshed'))
+            for reference_id, update_data in updates
+        ]
+        result = await self.db.file_references.bulk_write(operations, ordered=False)
+        return result.modified_count
+    
+    async def iter_expired_file_references(self, hours: int = 23,
+                                           batch_size: int = 500) -> AsyncIterator[Dict[str, Any]]:
+        """Yield file references that need refresh, fetched batch_size at a time"""
         cutoff_time = datetime.utcnow() - timedelta(hours=hours)
-        cursor = self.db.file_references.find({
-            "last_refreshed": {"$lt": cutoff_time}
-        })
+        cursor = self.db.file_references.find(
+            {"last_refreshed": {"$lt": cutoff_time}},
+            projection={
+                "reference_id": 1,
+                "telegram_file_id": 1,
+                "last_refreshed": 1,
+                "filename": 1,
+                "file_type": 1,
+                "metadata.channel_id": 1
+            }
+        ).batch_size(batch_size)
         
-        refs = []
         async for ref in cursor:
-            ref['_id'] = str(ref['_id'])
-            refs.append(ref)
-        return refs
+            yield ref
     
     # Statistics operations
     async def get_total_users_count(self) -> int:
@@ -459,4 +823,58 @@ class Database:
     
     async def get_total_media_files_count(self) -> int:
         """Get total media files count"""
-        return await self.db.media_files.count_documents({})
\ No newline at end of file
+        return await self.db.media_files.count_documents({})
+    
+    async def get_media_type_counts(self) -> Dict[str, int]:
+        """Get active media file counts per file type in one aggregation"""
+        pipeline = [
+            {"$match": {"is_active": True}},
+            {"$group": {"_id": "$file_type", "count": {"$sum": 1}}}
+        ]
+        cursor = self.db.media_files.aggregate(pipeline)
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        
+        counts = {"video": 0, "pdf": 0, "document": 0}
+        for doc in await cursor.to_list(length=None):
+            counts[doc['_id']] = doc['count']
+        counts['total'] = sum(counts.values())
+        return counts
+    
+    async def get_dashboard_stats(self, active_days: int = 30) -> Dict[str, int]:
+        """Get all dashboard counters in one concurrent round of queries"""
+        cutoff_date = datetime.utcnow() - timedelta(days=active_days)
+        total_users, active_users, total_apps, total_courses, total_media_files = await asyncio.gather(
+            self.db.users.count_documents({}),
+            self.db.users.count_documents({"last_activity": {"$gte": cutoff_date}}),
+            self.db.apps.count_documents({"is_active": True}),
+            self.db.courses.count_documents({"is_active": True}),
+            self.db.media_files.count_documents({})
+        )
+        return {
+            "total_users": total_users,
+            "active_users": active_users,
+            "total_apps": total_apps,
+            "total_courses": total_courses,
+            "total_media_files": total_media_files
+        }
+    
+    # Background job leases
+    async def acquire_lease(self, name: str, owner: str, seconds: int) -> bool:
+        """Take or renew the named lease for owner
+        
+        With several app workers each running the same background loops,
+        only the lease holder does the work. The lease can be taken over
+        once it has expired, so a dead holder is replaced after seconds.
+        """
+        now = datetime.utcnow()
+        try:
+            await self.db.leases.update_one(
+                {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Held by another owner: the filter missed and the upsert hit its _id
+            return False
+        return True
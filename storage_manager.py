@@ -1,26 +1,104 @@
 import os
+import re
+import time
 import asyncio
 import logging
-from typing import Optional, Dict, Any, List, Tuple
-from datetime import datetime, timedelta
+import socket
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, BinaryIO
+from datetime import timezone
 from telegram import Bot, Update, Message
 from telegram.error import TelegramError
 import aiohttp
-import hashlib
-import secrets
-import json
-import mimetypes
-from urllib.parse import quote
-import io
+from cachetools import TTLCache
+import tempfile
 
 logger = logging.getLogger(__name__)
 
+_urandom = os.urandom
+
+_VIDEO_PREFIX = 'video/'
+# Document MIME types with a dedicated file type; videos match on prefix
+_DOC_TYPE_MAP = {'application/pdf': 'pdf'}
+
+# Chunk size used when relaying Telegram downloads to clients
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Chunks read ahead from Telegram while the client drains earlier ones
+STREAM_PREFETCH_CHUNKS = 4
+# File references re-stamped per bulk write by the refresh task
+REFRESH_BATCH_SIZE = 100
+# Seconds an unmapped channel is remembered before the mapping is looked up again
+CHANNEL_MISS_TTL = 30
+# Seconds between file refresh runs, and how long a worker's refresh lease lasts
+REFRESH_INTERVAL = 3600
+REFRESH_LEASE_SECONDS = 2 * REFRESH_INTERVAL
+# Files above this size are spooled to disk by get_file_object
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range Range header into inclusive (start, end) offsets
+    
+    Returns None when the header is malformed, asks for several ranges or
+    cannot be satisfied for a file of file_size bytes.
+    """
+    match = _RANGE_RE.match(range_header.strip())
+    if not match or file_size <= 0:
+        return None
+    
+    start, end = match.groups()
+    if not start:
+        # Suffix range: the last N bytes
+        if not end or int(end) == 0:
+            return None
+        return max(file_size - int(end), 0), file_size - 1
+    
+    start = int(start)
+    end = min(int(end), file_size - 1) if end else file_size - 1
+    if start > end:
+        return None
+    return start, end
+
+def _classify(message: Message) -> Tuple[Optional[Any], Optional[str]]:
+    """Return the media object and file type of a channel message
+    
+    Returns (None, None) for messages without a document or video.
+    """
+    doc = message.document
+    if doc:
+        mime_type = doc.mime_type or ''
+        file_type = _DOC_TYPE_MAP.get(mime_type)
+        if file_type is None:
+            file_type = 'video' if mime_type.startswith(_VIDEO_PREFIX) else 'document'
+        return doc, file_type
+    
+    video = message.video
+    if video:
+        return video, 'video'
+    return None, None
+
 class StorageManager:
     def __init__(self, database):
         self.database = database
+        # Long-lived keep-alive session for Telegram downloads, see _get_session
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Hot file reference documents keyed by reference_id
+        self._ref_cache = TTLCache(maxsize=4096, ttl=300)
+        # Bumped on reference writes so reads that raced them are not cached
+        self._ref_generation = 0
+        # Channel mappings keyed by channel_id. Misses expire much sooner, since
+        # a mapping may be created elsewhere (admin panel, another worker)
+        self._channel_map_cache = TTLCache(maxsize=512, ttl=600)
+        self._channel_miss_cache = TTLCache(maxsize=1024, ttl=CHANNEL_MISS_TTL)
+        # Storage stats for the admin dashboard, which polls them
+        self._stats_cache = TTLCache(maxsize=1, ttl=60)
+        # In-flight get_fresh_file_id lookups keyed by reference_id
+        self._inflight: Dict[str, asyncio.Task] = {}
         self.bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
         self.bot = Bot(token=self.bot_token) if self.bot_token else None
         self.file_refresh_interval = 23  # hours
+        # Identifies this process when competing for the refresh lease
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}"
         
     async def create_file_reference(self, telegram_file_id: str, file_type: str, 
                                   filename: str, file_size: int, 
@@ -43,64 +121,138 @@ class StorageManager:
         logger.info(f"Created file reference: {reference_id}")
         return reference_id
     
+    async def _get_file_reference(self, reference_id: str) -> Optional[Dict[str, Any]]:
+        """Get file reference, served from memory when recently read"""
+        file_ref = self._ref_cache.get(reference_id)
+        if file_ref is None:
+            generation = self._ref_generation
+            file_ref = await self.database.get_file_reference(reference_id)
+            # Skip caching if a reference was written while the read was in flight
+            if file_ref and generation == self._ref_generation:
+                self._ref_cache[reference_id] = file_ref
+        return file_ref
+    
+    async def _update_file_reference(self, reference_id: str, update_data: Dict[str, Any]) -> bool:
+        """Update file reference and drop the cached copy"""
+        try:
+            return await self.database.update_file_reference(reference_id, update_data)
+        finally:
+            self._evict_file_references([reference_id])
+    
+    def _evict_file_references(self, reference_ids: List[str]):
+        """Drop cached references; call after the write has completed"""
+        self._ref_generation += 1
+        for reference_id in reference_ids:
+            self._ref_cache.pop(reference_id, None)
+    
+    async def _get_channel_mapping(self, channel_id: str) -> Optional[Dict[str, Any]]:
+        """Get channel mapping, caching misses too so unmapped chats stay cheap"""
+        mapping = self._channel_map_cache.get(channel_id)
+        if mapping is not None or channel_id in self._channel_miss_cache:
+            return mapping
+        
+        mapping = await self.database.get_channel_mapping(channel_id)
+        if mapping:
+            self._channel_map_cache[channel_id] = mapping
+        else:
+            self._channel_miss_cache[channel_id] = True
+        return mapping
+    
+    def _is_fresh(self, file_ref: Dict[str, Any]) -> bool:
+        """Whether file_ref was refreshed within the refresh window"""
+        last_refreshed = file_ref.get('last_refreshed')
+        if not last_refreshed:
+            return False
+        # Stored datetimes are naive UTC; compare as epoch seconds
+        last_ts = last_refreshed.replace(tzinfo=timezone.utc).timestamp()
+        return time.time() - last_ts < (self.file_refresh_interval * 3600)
+    
     async def get_fresh_file_id(self, reference_id: str) -> Optional[str]:
-        """Get fresh file ID, refresh if needed"""
-        file_ref = await self.database.get_file_reference(reference_id)
+        """Get fresh file ID, refresh if needed
+        
+        Concurrent calls for the same reference share a single lookup.
+        """
+        file_ref = self._ref_cache.get(reference_id)
+        if file_ref and self._is_fresh(file_ref):
+            return file_ref['telegram_file_id']
+        
+        task = self._inflight.get(reference_id)
+        if task is None:
+            task = asyncio.create_task(self._resolve_file_id(reference_id))
+            self._inflight[reference_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(reference_id, None))
+        # Shielded so one cancelled caller does not cancel the others' lookup
+        return await asyncio.shield(task)
+    
+    async def _resolve_file_id(self, reference_id: str) -> Optional[str]:
+        file_ref = await self._get_file_reference(reference_id)
         
         if not file_ref:
             logger.error(f"File reference not found: {reference_id}")
             return None
         
-        # Check if refresh is needed
-        last_refreshed = file_ref.get('last_refreshed')
-        if last_refreshed:
-            time_diff = datetime.utcnow() - last_refreshed
-            if time_diff.total_seconds() < (self.file_refresh_interval * 3600):
-                return file_ref['telegram_file_id']
-        
-        # Need to refresh
-        fresh_file_id = await self.refresh_file_id(file_ref)
-        return fresh_file_id
+        return await self.refresh_file_id(file_ref)
     
     async def refresh_file_id(self, file_ref: Dict[str, Any]) -> Optional[str]:
-        """Refresh telegram file ID by re-fetching from source"""
+        """Refresh telegram file ID
+        
+        IDs inside the refresh window are returned as-is. Older ones are
+        trusted and re-stamped without probing Telegram; an ID Telegram
+        actually rejects is replaced by invalidate_and_refresh() when a
+        download fails.
+        """
+        current_file_id = file_ref['telegram_file_id']
+        if self._is_fresh(file_ref):
+            return current_file_id
+        
         try:
-            # Try to get file info to validate current file_id
-            current_file_id = file_ref['telegram_file_id']
+            await self._update_file_reference(
+                file_ref['reference_id'],
+                {"telegram_file_id": current_file_id}
+            )
+        except Exception as e:
+            logger.error(f"Error refreshing file ID: {e}")
+        return current_file_id
+    
+    async def invalidate_and_refresh(self, reference_id: str) -> Optional[str]:
+        """Replace a file ID Telegram rejected by finding the file again"""
+        file_ref = await self._get_file_reference(reference_id)
+        if not file_ref:
+            return None
+        
+        logger.warning(f"File ID expired for reference: {reference_id}")
+        try:
+            # Try to find the file again in the channel/group
+            new_file_id = await self.find_file_in_channel(
+                file_ref['metadata'].get('channel_id'),
+                file_ref['filename'],
+                file_ref['file_type']
+            )
             
-            try:
-                file_info = await self.bot.get_file(current_file_id)
-                # If successful, update timestamp and return current ID
-                await self.database.update_file_reference(
-                    file_ref['reference_id'],
-                    {"telegram_file_id": current_file_id}
-                )
-                return current_file_id
-            except TelegramError:
-                # File ID expired, need to find new one
-                logger.warning(f"File ID expired for reference: {file_ref['reference_id']}")
-                
-                # Try to find the file again in the channel/group
-                new_file_id = await self.find_file_in_channel(
-                    file_ref['metadata'].get('channel_id'),
-                    file_ref['filename'],
-                    file_ref['file_type']
+            if new_file_id:
+                await self._update_file_reference(
+                    reference_id,
+                    {"telegram_file_id": new_file_id}
                 )
-                
-                if new_file_id:
-                    await self.database.update_file_reference(
-                        file_ref['reference_id'],
-                        {"telegram_file_id": new_file_id}
-                    )
-                    return new_file_id
-                
-                logger.error(f"Could not refresh file ID for: {file_ref['reference_id']}")
-                return None
-                
+                return new_file_id
+            
+            logger.error(f"Could not refresh file ID for: {reference_id}")
+            return None
+            
         except Exception as e:
             logger.error(f"Error refreshing file ID: {e}")
             return None
     
+    async def _get_telegram_file(self, reference_id: str, file_id: str):
+        """Resolve file_id with Telegram, re-finding the file once if it is rejected"""
+        try:
+            return await self.bot.get_file(file_id)
+        except TelegramError:
+            new_file_id = await self.invalidate_and_refresh(reference_id)
+            if not new_file_id:
+                raise
+            return await self.bot.get_file(new_file_id)
+    
     async def find_file_in_channel(self, channel_id: str, filename: str, file_type: str) -> Optional[str]:
         """Find file in channel by filename and type"""
         try:
@@ -119,36 +271,160 @@ class StorageManager:
             logger.error(f"Error finding file in channel: {e}")
             return None
     
-    async def get_file_stream(self, reference_id: str) -> Optional[Tuple[io.BytesIO, str, int]]:
-        """Get file stream by reference ID"""
+    async def get_file_stream(self, reference_id: str,
+                              range_header: Optional[str] = None) -> Optional[Tuple[AsyncIterator[bytes], str, int]]:
+        """Get file stream by reference ID
+        
+        Returns an async iterator relaying the download in STREAM_CHUNK_SIZE
+        pieces, so the file is never held in memory as a whole. A background
+        task reads up to STREAM_PREFETCH_CHUNKS ahead of the client. With a
+        range_header only the bytes selected by parse_byte_range() are
+        relayed; the returned size is always the full file size, so callers
+        can build Content-Range from the same parse.
+        
+        The download itself starts on first iteration, so upstream HTTP
+        errors surface from the iterator. Once iteration has started, run it
+        to the end or aclose() it to release the connection promptly.
+        """
         file_id = await self.get_fresh_file_id(reference_id)
         
         if not file_id:
             return None
         
+        # Get file reference for metadata
+        file_ref = await self._get_file_reference(reference_id)
+        file_size = file_ref.get('file_size') or 0
+        byte_range = parse_byte_range(range_header, file_size) if range_header else None
+        
         try:
-            file_info = await self.bot.get_file(file_id)
-            
-            # Download file
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file_info.file_path) as response:
-                    if response.status == 200:
-                        content = await response.read()
-                        
-                        # Get file reference for metadata
-                        file_ref = await self.database.get_file_reference(reference_id)
-                        
-                        return (
-                            io.BytesIO(content),
-                            file_ref.get('filename', 'unknown'),
-                            len(content)
-                        )
-            
-            return None
-            
+            file_info = await self._get_telegram_file(reference_id, file_id)
         except Exception as e:
             logger.error(f"Error getting file stream: {e}")
             return None
+        
+        return (
+            self._prefetch(self._iter_download(file_info.file_path, byte_range)),
+            file_ref.get('filename', 'unknown'),
+            file_size or file_info.file_size or 0
+        )
+    
+    async def get_file_object(self, reference_id: str) -> Optional[Tuple[BinaryIO, str, int]]:
+        """Get file as a seekable file object by reference ID
+        
+        For callers that need a real file rather than a stream. Small files
+        stay in memory; anything above SPOOL_MAX_MEMORY is spilled to a
+        temporary file on disk.
+        """
+        stream = await self.get_file_stream(reference_id)
+        if not stream:
+            return None
+        
+        chunks, filename, _ = stream
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        try:
+            async for chunk in chunks:
+                spool.write(chunk)
+        except Exception as e:
+            spool.close()
+            logger.error(f"Error downloading file: {e}")
+            return None
+        
+        size = spool.tell()
+        spool.seek(0)
+        return spool, filename, size
+    
+    async def _iter_download(self, url: str,
+                             byte_range: Optional[Tuple[int, int]] = None) -> AsyncIterator[bytes]:
+        """Download url chunk by chunk, limited to byte_range when given
+        
+        The request is only opened once the iterator is first advanced, so an
+        iterator that is dropped unused holds no connection. Raises
+        aiohttp.ClientError if Telegram answers with anything but 200/206.
+        """
+        headers = {"Range": f"bytes={byte_range[0]}-{byte_range[1]}"} if byte_range else None
+        session = await self._get_session()
+        async with session.get(url, headers=headers) as response:
+            if response.status not in (200, 206):
+                raise aiohttp.ClientError(f"Unexpected status {response.status} downloading file")
+            
+            skip, limit = 0, None
+            if byte_range:
+                limit = byte_range[1] - byte_range[0] + 1
+                if response.status == 200:
+                    # Upstream ignored the Range header and sent the whole file
+                    skip = byte_range[0]
+            
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk = chunk[skip:]
+                    skip = 0
+                if limit is not None:
+                    if len(chunk) >= limit:
+                        yield chunk[:limit]
+                        break
+                    limit -= len(chunk)
+                yield chunk
+    
+    async def _prefetch(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Read chunks in a background task so download and send overlap
+        
+        The bounded queue keeps memory at STREAM_PREFETCH_CHUNKS chunks. If
+        the consumer stops early the producer is cancelled, which closes the
+        underlying iterator and releases its connection.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_PREFETCH_CHUNKS)
+        done = object()
+        
+        async def produce():
+            try:
+                async for chunk in chunks:
+                    await queue.put(chunk)
+            except Exception as e:
+                await queue.put(e)
+            finally:
+                # Close now rather than at GC, so the connection is released promptly
+                await chunks.aclose()
+            await queue.put(done)
+        
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared download session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                # Nearly all traffic goes to one host, so the per-host cap is what
+                # bounds concurrent downloads
+                connector=aiohttp.TCPConnector(
+                    limit=256,
+                    limit_per_host=32,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=75,
+                    enable_cleanup_closed=True
+                ),
+                # No total timeout: streamed video downloads can legitimately run long
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30),
+                trust_env=True
+            )
+        return self._session
+    
+    async def close(self):
+        """Close the shared download session"""
+        if self._session and not self._session.closed:
+            await self._session.close()
     
     async def get_file_url(self, reference_id: str) -> Optional[str]:
         """Get temporary file URL by reference ID"""
@@ -158,7 +434,7 @@ class StorageManager:
             return None
         
         try:
-            file_info = await self.bot.get_file(file_id)
+            file_info = await self._get_telegram_file(reference_id, file_id)
             return file_info.file_path
         except Exception as e:
             logger.error(f"Error getting file URL: {e}")
@@ -168,7 +444,7 @@ class StorageManager:
         """Sync all content from a Telegram channel/group"""
         try:
             # Check if channel mapping exists
-            mapping = await self.database.get_channel_mapping(channel_id)
+            mapping = await self._get_channel_mapping(channel_id)
             
             if not mapping:
                 # Create new mapping
@@ -178,6 +454,7 @@ class StorageManager:
                     "is_active": True
                 }
                 await self.database.create_channel_mapping(mapping_data)
+                self._channel_miss_cache.pop(channel_id, None)
             
             # Get channel info
             try:
@@ -188,9 +465,8 @@ class StorageManager:
             
             # In a real implementation, you would:
             # 1. Scan through channel messages
-            # 2. Find all media files (videos, documents)
-            # 3. Create file references for each
-            # 4. Associate with the course
+            # 2. Pass them to ingest_channel_messages, which finds the media
+            #    files and bulk-creates their references and media records
             
             # For now, we'll return a success response
             # You would implement the actual scanning logic here
@@ -222,99 +498,148 @@ class StorageManager:
                 return
             
             # Check if this channel is mapped to any course
-            mapping = await self.database.get_channel_mapping(str(chat.id))
+            mapping = await self._get_channel_mapping(str(chat.id))
             if not mapping:
                 return
             
-            # Process different types of media
-            file_info = None
-            file_type = None
-            
-            if message.document:
-                file_info = message.document
-                if message.document.mime_type:
-                    if 'video' in message.document.mime_type:
-                        file_type = 'video'
-                    elif 'pdf' in message.document.mime_type:
-                        file_type = 'pdf'
-                    else:
-                        file_type = 'document'
-                else:
-                    file_type = 'document'
-            
-            elif message.video:
-                file_info = message.video
-                file_type = 'video'
-            
-            if file_info and file_type:
-                # Create file reference
-                metadata = {
-                    "channel_id": str(chat.id),
-                    "channel_name": chat.title,
-                    "message_id": message.message_id,
-                    "mime_type": getattr(file_info, 'mime_type', None)
-                }
-                
-                reference_id = await self.create_file_reference(
-                    telegram_file_id=file_info.file_id,
-                    file_type=file_type,
-                    filename=getattr(file_info, 'file_name', f"{file_type}_{file_info.file_id[:10]}"),
-                    file_size=file_info.file_size,
-                    course_id=mapping['course_id'],
-                    metadata=metadata
-                )
-                
-                # Create media file record
-                media_data = {
-                    "reference_id": reference_id,
-                    "course_id": mapping['course_id'],
-                    "file_type": file_type,
-                    "filename": getattr(file_info, 'file_name', f"{file_type}_{file_info.file_id[:10]}"),
-                    "file_size": file_info.file_size,
-                    "telegram_file_id": file_info.file_id,
-                    "channel_id": str(chat.id),
-                    "message_id": message.message_id,
-                    "order": 0,  # You might want to implement ordering logic
-                    "is_active": True
-                }
-                
+            records = self._build_media_records(message, mapping['course_id'])
+            if records:
+                reference_data, media_data = records
+                await self.database.create_file_reference(reference_data)
                 await self.database.create_media_file(media_data)
-                logger.info(f"Processed media file: {reference_id}")
+                logger.info(f"Processed media file: {reference_data['reference_id']}")
         
         except Exception as e:
             logger.error(f"Error processing channel media: {e}")
     
+    async def ingest_channel_messages(self, messages: List[Message], course_id: str) -> int:
+        """Create file references and media records for many channel messages
+        
+        Both collections are written with one insert_many each instead of two
+        inserts per file. Returns the number of media files ingested.
+        """
+        references = []
+        media_files = []
+        for message in messages:
+            records = self._build_media_records(message, course_id)
+            if records:
+                references.append(records[0])
+                media_files.append(records[1])
+        
+        if not references:
+            return 0
+        await self.database.bulk_create_file_references(references)
+        await self.database.bulk_create_media_files(media_files)
+        logger.info(f"Ingested {len(media_files)} media files for course {course_id}")
+        return len(media_files)
+    
+    def _build_media_records(self, message: Message, course_id: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Build the file reference and media file documents for a media message
+        
+        The reference ID is generated here so both documents can point at it
+        before either is inserted. Returns None for messages without media.
+        """
+        chat = message.chat
+        
+        file_info, file_type = _classify(message)
+        
+        if not (file_info and file_type):
+            return None
+        
+        file_id = file_info.file_id
+        file_size = file_info.file_size
+        filename = getattr(file_info, 'file_name', None) or f"{file_type}_{file_id[:10]}"
+        channel_id = str(chat.id)
+        message_id = message.message_id
+        reference_id = self.generate_reference_id()
+        
+        # File reference
+        metadata = {
+            "channel_id": channel_id,
+            "channel_name": chat.title,
+            "message_id": message_id,
+            "mime_type": getattr(file_info, 'mime_type', None)
+        }
+        
+        reference_data = {
+            "reference_id": reference_id,
+            "telegram_file_id": file_id,
+            "file_type": file_type,
+            "filename": filename,
+            "file_size": file_size,
+            "course_id": course_id,
+            "metadata": metadata,
+            "is_active": True
+        }
+        
+        # Media file record
+        media_data = {
+            "reference_id": reference_id,
+            "course_id": course_id,
+            "file_type": file_type,
+            "filename": filename,
+            "file_size": file_size,
+            "telegram_file_id": file_id,
+            "channel_id": channel_id,
+            "message_id": message_id,
+            "order": 0,  # You might want to implement ordering logic
+            "is_active": True
+        }
+        
+        return reference_data, media_data
+    
     async def start_file_refresh_task(self):
-        """Start background task to refresh expired file IDs"""
+        """Start background task to refresh expired file IDs
+        
+        Every app worker runs this loop, but only the one holding the
+        file_refresh lease does the refresh; the others just check again
+        next interval and take over if the holder stops renewing.
+        """
         logger.info("Starting file refresh background task")
         
         while True:
             try:
-                # Get files that need refresh
-                expired_refs = await self.database.get_expired_file_references(self.file_refresh_interval)
+                if not await self.database.acquire_lease("file_refresh", self._worker_id, REFRESH_LEASE_SECONDS):
+                    await asyncio.sleep(REFRESH_INTERVAL)
+                    continue
                 
-                for file_ref in expired_refs:
-                    logger.info(f"Refreshing file: {file_ref['reference_id']}")
-                    await self.refresh_file_id(file_ref)
-                    
-                    # Small delay to avoid rate limiting
-                    await asyncio.sleep(1)
+                # Stream files that need refresh instead of loading them all at once.
+                # Refreshing an expired ID is only a re-stamp (see refresh_file_id),
+                # so the writes are batched into bulk updates.
+                batch = []
+                refreshed = 0
+                async for file_ref in self.database.iter_expired_file_references(self.file_refresh_interval):
+                    batch.append(file_ref['reference_id'])
+                    if len(batch) >= REFRESH_BATCH_SIZE:
+                        refreshed += await self._flush_refreshes(batch)
+                        batch = []
+                refreshed += await self._flush_refreshes(batch)
                 
-                if expired_refs:
-                    logger.info(f"Refreshed {len(expired_refs)} file references")
+                if refreshed:
+                    logger.info(f"Refreshed {refreshed} file references")
                 
                 # Sleep for 1 hour before next check
-                await asyncio.sleep(3600)
+                await asyncio.sleep(REFRESH_INTERVAL)
                 
             except Exception as e:
                 logger.error(f"Error in file refresh task: {e}")
                 await asyncio.sleep(300)  # Sleep 5 minutes on error
     
+    async def _flush_refreshes(self, reference_ids: List[str]) -> int:
+        """Re-stamp a batch of file references with one bulk write"""
+        if not reference_ids:
+            return 0
+        try:
+            await self.database.bulk_update_file_references(
+                [(reference_id, {}) for reference_id in reference_ids]
+            )
+        finally:
+            self._evict_file_references(reference_ids)
+        return len(reference_ids)
+    
     def generate_reference_id(self) -> str:
         """Generate unique reference ID"""
-        timestamp = str(int(datetime.utcnow().timestamp()))
-        random_part = secrets.token_hex(8)
-        return f"ref_{timestamp}_{random_part}"
+        return f"ref_{time.time_ns() // 1_000_000_000}_{_urandom(8).hex()}"
     
     async def get_media_files_by_course(self, course_id: str, file_type: str = None) -> List[Dict[str, Any]]:
         """Get media files for a course"""
@@ -324,7 +649,7 @@ class StorageManager:
         """Delete file reference"""
         try:
             # Update file reference as inactive
-            return await self.database.update_file_reference(
+            return await self._update_file_reference(
                 reference_id,
                 {"is_active": False}
             )
@@ -334,7 +659,7 @@ class StorageManager:
     
     async def get_file_metadata(self, reference_id: str) -> Optional[Dict[str, Any]]:
         """Get file metadata by reference ID"""
-        file_ref = await self.database.get_file_reference(reference_id)
+        file_ref = await self._get_file_reference(reference_id)
         
         if not file_ref:
             return None
@@ -357,26 +682,28 @@ class StorageManager:
             return False
         
         try:
-            await self.bot.get_file(file_id)
+            await self._get_telegram_file(reference_id, file_id)
             return True
         except Exception:
             return False
     
     async def get_storage_stats(self) -> Dict[str, Any]:
         """Get storage statistics"""
+        stats = self._stats_cache.get('storage')
+        if stats is not None:
+            return stats
+        
         try:
-            total_files = await self.database.get_total_media_files_count()
+            counts = await self.database.get_media_type_counts()
             
-            # Get file type breakdown
-            video_files = len(await self.database.get_course_media_files("", "video"))
-            pdf_files = len(await self.database.get_course_media_files("", "pdf"))
-            
-            return {
-                "total_files": total_files,
-                "video_files": video_files,
-                "pdf_files": pdf_files,
-                "document_files": total_files - video_files - pdf_files
+            stats = {
+                "total_files": counts['total'],
+                "video_files": counts['video'],
+                "pdf_files": counts['pdf'],
+                "document_files": counts['total'] - counts['video'] - counts['pdf']
             }
+            self._stats_cache['storage'] = stats
+            return stats
         except Exception as e:
             logger.error(f"Error getting storage stats: {e}")
             return {
@@ -384,4 +711,4 @@ class StorageManager:
                 "video_files": 0,
                 "pdf_files": 0,
                 "document_files": 0
-            }
\ No newline at end of file
+            }
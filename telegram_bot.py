@@ -1,17 +1,90 @@
 import os
 import asyncio
 import logging
-from typing import Optional, Dict, Any, List
-from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+from datetime import timedelta
 from telegram import Bot, Update, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.error import TelegramError
+from aiolimiter import AsyncLimiter
 import hashlib
 import secrets
 import json
 
 logger = logging.getLogger(__name__)
 
+# Concurrent workers processing channel media updates
+MEDIA_WORKERS = 4
+# Seconds stop() waits for queued media before dropping it
+MEDIA_DRAIN_TIMEOUT = 10
+
+# Static message bodies, built once; templates only take the per-user values
+_BOT_COMMANDS = [
+    BotCommand("start", "Start the bot and get miniapp link"),
+    BotCommand("miniapp", "Get miniapp link"),
+    BotCommand("reset_device", "Reset your device (limited to 2 times)"),
+    BotCommand("status", "Check your enrollment status"),
+    BotCommand("help", "Show help information"),
+    BotCommand("admin", "Admin panel access")
+]
+
+_WELCOME_TEMPLATE = (
+    "🎓 Welcome to EduLearn, {first_name}!\n\n"
+    "📱 Access your educational content through our miniapp:\n"
+    "🔗 [Open Miniapp]({url})\n\n"
+    "📚 Features:\n"
+    "• Browse educational apps\n"
+    "• Access your assigned courses\n"
+    "• Watch videos and read PDFs\n"
+    "• Track your progress\n\n"
+    "💡 Use /help for more commands"
+)
+
+_HELP_TEXT = (
+    "🤖 **EduLearn Bot Help**\n\n"
+    "📋 **Available Commands:**\n"
+    "/start - Start the bot and get miniapp link\n"
+    "/miniapp - Get direct miniapp access\n"
+    "/reset_device - Reset your device registration (max 2 times)\n"
+    "/status - Check your enrollment and device status\n"
+    "/admin - Access admin panel (admin only)\n\n"
+    "📱 **How to use:**\n"
+    "1. Click on the miniapp link\n"
+    "2. Browse available apps\n"
+    "3. Access your assigned courses\n"
+    "4. Watch videos and read materials\n\n"
+    "🔒 **Security:**\n"
+    "• One device per user\n"
+    "• Device reset limited to 2 times\n"
+    "• Secure session management\n\n"
+    "❓ Need help? Contact support."
+)
+
+_MINIAPP_TEMPLATE = (
+    "📱 **Your Miniapp Access**\n\n"
+    "🔗 [Click here to open your miniapp]({url})\n\n"
+    "📚 Access all your educational content in one place!\n"
+    "🎯 Courses are personalized based on your enrollment."
+)
+
+_ADMIN_TEMPLATE = (
+    "👨‍💼 **Admin Panel Access**\n\n"
+    "🔗 [Open Admin Panel]({url})\n\n"
+    "🔐 Use your admin credentials to login\n"
+    "⚙️ Manage apps, courses, users, and media files"
+)
+
+_STATUS_TEMPLATE = (
+    "📊 **Your Status - {first_name}**\n\n"
+    "🆔 User ID: {telegram_id}\n"
+    "📅 Joined: {joined}\n"
+    "🔄 Device Resets: {reset_count}/2\n"
+    "📱 Device Status: {device_status}\n"
+    "🚫 Banned: {banned}\n\n"
+    "{courses}"
+    "\n🔗 Use /miniapp to access your content"
+)
+
 class TelegramBot:
     def __init__(self, database, storage_manager, file_manager):
         self.database = database
@@ -22,6 +95,15 @@ class TelegramBot:
         self.admin_password = os.getenv('ADMIN_PASSWORD', 'admin123')
         self.bot = None
         self.application = None
+        # Channel media is processed off the webhook path by _media_worker tasks
+        self._media_queue: Optional[asyncio.Queue] = None
+        self._media_workers: List[asyncio.Task] = []
+        # Set once the webhook is registered, so abort() knows to remove it
+        self._webhook_url: Optional[str] = None
+        # Paces outbound messages below Telegram's ~30 messages/second bot limit
+        self._send_limiter = AsyncLimiter(25, 1.0)
+        # Plain /command messages are dispatched straight from this map
+        self._cmd_map: Dict[str, Any] = {}
         
         if not self.bot_token:
             raise ValueError("TELEGRAM_BOT_TOKEN environment variable is required")
@@ -32,23 +114,35 @@ class TelegramBot:
             self.bot = Bot(token=self.bot_token)
             self.application = Application.builder().token(self.bot_token).build()
             
+            self._cmd_map = {
+                "start": self.start_command,
+                "help": self.help_command,
+                "miniapp": self.miniapp_command,
+                "reset_device": self.reset_device_command,
+                "status": self.status_command,
+                "admin": self.admin_command
+            }
+            
             # Add command handlers
-            self.application.add_handler(CommandHandler("start", self.start_command))
-            self.application.add_handler(CommandHandler("help", self.help_command))
-            self.application.add_handler(CommandHandler("miniapp", self.miniapp_command))
-            self.application.add_handler(CommandHandler("reset_device", self.reset_device_command))
-            self.application.add_handler(CommandHandler("status", self.status_command))
-            self.application.add_handler(CommandHandler("admin", self.admin_command))
+            for command, callback in self._cmd_map.items():
+                self.application.add_handler(CommandHandler(command, callback))
             
             # Add message handlers for file processing
             self.application.add_handler(MessageHandler(filters.Document.PDF | filters.Document.VIDEO | filters.VIDEO, self.handle_media))
             
+            # Start channel media workers
+            self._media_queue = asyncio.Queue(maxsize=1000)
+            self._media_workers = [
+                asyncio.create_task(self._media_worker()) for _ in range(MEDIA_WORKERS)
+            ]
+            
             # Set bot commands
             await self.set_bot_commands()
             
             # Set webhook
             webhook_url = f"{self.webapp_url}/telegram/webhook"
             await self.bot.set_webhook(webhook_url)
+            self._webhook_url = webhook_url
             
             logger.info(f"Telegram bot initialized successfully with webhook: {webhook_url}")
             
@@ -58,16 +152,7 @@ class TelegramBot:
     
     async def set_bot_commands(self):
         """Set bot commands menu"""
-        commands = [
-            BotCommand("start", "Start the bot and get miniapp link"),
-            BotCommand("miniapp", "Get miniapp link"),
-            BotCommand("reset_device", "Reset your device (limited to 2 times)"),
-            BotCommand("status", "Check your enrollment status"),
-            BotCommand("help", "Show help information"),
-            BotCommand("admin", "Admin panel access")
-        ]
-        
-        await self.bot.set_my_commands(commands)
+        await self.bot.set_my_commands(_BOT_COMMANDS)
         logger.info("Bot commands set successfully")
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -75,38 +160,20 @@ class TelegramBot:
         user = update.effective_user
         chat_id = update.effective_chat.id
         
-        # Check if user exists
-        existing_user = await self.database.get_user_by_telegram_id(str(user.id))
+        # Create the user or touch last activity in a single round trip
+        user_data, created = await self.database.upsert_user_on_start(str(user.id), {
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "chat_id": str(chat_id)
+        })
         
-        if not existing_user:
-            # Create new user
-            user_data = {
-                "telegram_id": str(user.id),
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "chat_id": str(chat_id)
-            }
-            
-            user_id = await self.database.create_user(user_data)
-            logger.info(f"New user created: {user_id}")
-        else:
-            # Update last activity
-            await self.database.update_user(existing_user['_id'], {"last_activity": datetime.utcnow()})
+        if created:
+            logger.info(f"New user created: {user_data['_id']}")
         
         miniapp_url = f"{self.webapp_url}/miniapp?user_id={user.id}"
         
-        welcome_message = (
-            f"🎓 Welcome to EduLearn, {user.first_name}!\n\n"
-            "📱 Access your educational content through our miniapp:\n"
-            f"🔗 [Open Miniapp]({miniapp_url})\n\n"
-            "📚 Features:\n"
-            "• Browse educational apps\n"
-            "• Access your assigned courses\n"
-            "• Watch videos and read PDFs\n"
-            "• Track your progress\n\n"
-            "💡 Use /help for more commands"
-        )
+        welcome_message = _WELCOME_TEMPLATE.format(first_name=user.first_name, url=miniapp_url)
         
         await context.bot.send_message(
             chat_id=chat_id,
@@ -117,39 +184,14 @@ class TelegramBot:
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        help_text = (
-            "🤖 **EduLearn Bot Help**\n\n"
-            "📋 **Available Commands:**\n"
-            "/start - Start the bot and get miniapp link\n"
-            "/miniapp - Get direct miniapp access\n"
-            "/reset_device - Reset your device registration (max 2 times)\n"
-            "/status - Check your enrollment and device status\n"
-            "/admin - Access admin panel (admin only)\n\n"
-            "📱 **How to use:**\n"
-            "1. Click on the miniapp link\n"
-            "2. Browse available apps\n"
-            "3. Access your assigned courses\n"
-            "4. Watch videos and read materials\n\n"
-            "🔒 **Security:**\n"
-            "• One device per user\n"
-            "• Device reset limited to 2 times\n"
-            "• Secure session management\n\n"
-            "❓ Need help? Contact support."
-        )
-        
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+        await update.message.reply_text(_HELP_TEXT, parse_mode='Markdown')
     
     async def miniapp_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /miniapp command"""
         user = update.effective_user
         miniapp_url = f"{self.webapp_url}/miniapp?user_id={user.id}"
         
-        message = (
-            f"📱 **Your Miniapp Access**\n\n"
-            f"🔗 [Click here to open your miniapp]({miniapp_url})\n\n"
-            "📚 Access all your educational content in one place!\n"
-            "🎯 Courses are personalized based on your enrollment."
-        )
+        message = _MINIAPP_TEMPLATE.format(url=miniapp_url)
         
         await update.message.reply_text(
             message,
@@ -213,24 +255,21 @@ class TelegramBot:
         # Get user courses
         courses = await self.database.get_user_courses(user_data['_id'])
         
-        # Build status message
-        status_message = (
-            f"📊 **Your Status - {user.first_name}**\n\n"
-            f"🆔 User ID: {user_data['telegram_id']}\n"
-            f"📅 Joined: {user_data['created_at'].strftime('%Y-%m-%d')}\n"
-            f"🔄 Device Resets: {user_data.get('device_reset_count', 0)}/2\n"
-            f"📱 Device Status: {'✅ Registered' if user_data.get('device_fingerprint') else '❌ Not Registered'}\n"
-            f"🚫 Banned: {'Yes' if user_data.get('is_banned') else 'No'}\n\n"
-        )
-        
         if courses:
-            status_message += "📚 **Enrolled Courses:**\n"
-            for course in courses:
-                status_message += f"• {course['name']} (ID: {course['course_id']})\n"
+            course_lines = "\n".join(f"• {course['name']} (ID: {course['course_id']})" for course in courses)
+            courses_block = f"📚 **Enrolled Courses:**\n{course_lines}\n"
         else:
-            status_message += "📚 **No courses assigned yet**\n"
+            courses_block = "📚 **No courses assigned yet**\n"
         
-        status_message += "\n🔗 Use /miniapp to access your content"
+        status_message = _STATUS_TEMPLATE.format(
+            first_name=user.first_name,
+            telegram_id=user_data['telegram_id'],
+            joined=user_data['created_at'].strftime('%Y-%m-%d'),
+            reset_count=user_data.get('device_reset_count', 0),
+            device_status='✅ Registered' if user_data.get('device_fingerprint') else '❌ Not Registered',
+            banned='Yes' if user_data.get('is_banned') else 'No',
+            courses=courses_block
+        )
         
         await update.message.reply_text(status_message, parse_mode='Markdown')
     
@@ -238,12 +277,7 @@ class TelegramBot:
         """Handle /admin command"""
         admin_url = f"{self.webapp_url}/admin"
         
-        message = (
-            "👨‍💼 **Admin Panel Access**\n\n"
-            f"🔗 [Open Admin Panel]({admin_url})\n\n"
-            "🔐 Use your admin credentials to login\n"
-            "⚙️ Manage apps, courses, users, and media files"
-        )
+        message = _ADMIN_TEMPLATE.format(url=admin_url)
         
         await update.message.reply_text(
             message,
@@ -256,31 +290,98 @@ class TelegramBot:
         # This is primarily for channel/group media indexing
         # Will be processed by the storage manager
         if update.effective_chat.type in ['group', 'supergroup', 'channel']:
-            await self.storage_manager.process_channel_media(update)
+            # Queue it so the webhook returns without waiting on the database
+            await self._media_queue.put(update)
+    
+    async def _media_worker(self):
+        """Process queued channel media updates"""
+        while True:
+            update = await self._media_queue.get()
+            try:
+                await self.storage_manager.process_channel_media(update)
+            finally:
+                self._media_queue.task_done()
     
     async def process_update(self, update_data: dict):
         """Process incoming webhook update"""
         try:
             update = Update.de_json(update_data, self.bot)
+            
+            # Plain commands skip PTB's handler and filter walk
+            match = self._match_command(update)
+            if match:
+                callback, args = match
+                context = self.application.context_types.context.from_update(update, self.application)
+                # CommandHandler fills in args; do the same so handlers see no difference
+                context.args = args
+                await callback(update, context)
+                return
+            
             await self.application.process_update(update)
         except Exception as e:
             logger.error(f"Error processing update: {e}")
     
+    def _match_command(self, update: Update) -> Optional[Tuple[Any, List[str]]]:
+        """Return the handler and arguments for a plain /command message
+        
+        Commands addressed to a bot by @username are left to PTB, which
+        checks the name against ours.
+        """
+        message = update.message
+        if not message or not message.text or not message.text.startswith('/'):
+            return None
+        
+        command, *args = message.text.split()
+        command = command[1:]
+        if '@' in command:
+            return None
+        callback = self._cmd_map.get(command.lower())
+        return (callback, args) if callback else None
+    
     async def stop(self):
         """Stop the bot"""
+        if self._media_queue:
+            # Let queued media finish before shutting the workers down, but
+            # don't let a slow or unreachable Mongo hold up the rest of shutdown
+            try:
+                await asyncio.wait_for(self._media_queue.join(), timeout=MEDIA_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {self._media_queue.qsize()} queued media updates after {MEDIA_DRAIN_TIMEOUT}s shutdown drain")
+            await self._cancel_media_workers()
         if self.application:
             await self.application.stop()
             logger.info("Telegram bot stopped")
     
+    async def abort(self):
+        """Undo a partial initialize when the rest of startup failed
+        
+        Stops the media workers and removes the webhook, so Telegram does
+        not keep posting updates to an app that never came up.
+        """
+        await self._cancel_media_workers()
+        if self._webhook_url:
+            try:
+                await self.bot.delete_webhook()
+                self._webhook_url = None
+            except TelegramError as e:
+                logger.error(f"Failed to remove webhook: {e}")
+    
+    async def _cancel_media_workers(self):
+        for worker in self._media_workers:
+            worker.cancel()
+        await asyncio.gather(*self._media_workers, return_exceptions=True)
+        self._media_workers = []
+    
     async def send_message_to_user(self, telegram_id: str, message: str, parse_mode: str = 'Markdown') -> bool:
         """Send message to user by telegram ID"""
         try:
-            await self.bot.send_message(
-                chat_id=telegram_id,
-                text=message,
-                parse_mode=parse_mode,
-                disable_web_page_preview=True
-            )
+            async with self._send_limiter:
+                await self.bot.send_message(
+                    chat_id=telegram_id,
+                    text=message,
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True
+                )
             return True
         except Exception as e:
             logger.error(f"Failed to send message to {telegram_id}: {e}")
@@ -291,9 +392,11 @@ class TelegramBot:
         # Get admin users (you can implement admin user detection logic)
         admin_ids = os.getenv('ADMIN_IDS', '').split(',')
         
-        for admin_id in admin_ids:
-            if admin_id.strip():
-                await self.send_message_to_user(admin_id.strip(), message)
+        # Sent concurrently; the send limiter keeps the pace within bot limits
+        await asyncio.gather(*[
+            self.send_message_to_user(admin_id.strip(), message)
+            for admin_id in admin_ids if admin_id.strip()
+        ])
     
     async def notify_course_assignment(self, user_id: str, course_name: str):
         """Notify user about course assignment"""